@@ -1,9 +1,14 @@
 import os
-from datetime import datetime
-import pytz
-from flask import Flask, jsonify, request, send_from_directory, render_template
+import re
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import orjson
+from flask import Flask, request, send_from_directory, render_template
 from flask_cors import CORS
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, CheckConstraint
+from flask_compress import Compress
+from werkzeug.exceptions import BadRequest
+from whitenoise import WhiteNoise
+from sqlalchemy import create_engine, event, lambda_stmt, select, update, insert, literal, or_, case, func, Column, Integer, String, DateTime, ForeignKey, CheckConstraint, Index
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, scoped_session
 from sqlalchemy.exc import IntegrityError
 
@@ -21,10 +26,37 @@ def get_database_url():
     # Fallback local SQLite for dev
     return "sqlite:///silos.db"
 
+def get_engine_options(url):
+    # Pool explícito; reciclar conexiones sale más barato que un SELECT 1 por checkout
+    options = {"pool_size": 10, "max_overflow": 20, "pool_recycle": 1800, "pool_pre_ping": False}
+    if url.startswith("postgresql+psycopg://"):
+        # psycopg 3 ya prepara en el servidor las sentencias repetidas (prepare_threshold=5 por defecto)
+        options["connect_args"] = {
+            # TCP keepalives para que Render no corte las conexiones ociosas del pool
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+        }
+    return options
+
 DATABASE_URL = get_database_url()
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(DATABASE_URL, **get_engine_options(DATABASE_URL))
+
+if DATABASE_URL.startswith("sqlite"):
+    # Solo dev: WAL para que lecturas y escrituras concurrentes no se bloqueen
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_conn, _):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.close()
+
 SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
+# Proxy de la sesión del hilo actual; se libera una vez por request en teardown_appcontext
+db = SessionLocal
 Base = declarative_base()
 
 # ---------- Models ----------
@@ -34,7 +66,7 @@ class Silo(Base):
     name = Column(String(100), unique=True, nullable=False)
     cereal = Column(String(20), nullable=True)  # Soja, Maiz, Trigo, Girasol
     balance_kg = Column(Integer, nullable=False, default=0)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), default=func.now(), server_default=func.now(), nullable=False)
 
     operations = relationship("Operation", back_populates="silo", cascade="all, delete")
 
@@ -48,182 +80,308 @@ class Operation(Base):
     silo_id = Column(Integer, ForeignKey("silos.id", ondelete="CASCADE"), nullable=False)
     type = Column(String(10), nullable=False)  # CARGA / DESCARGA
     amount = Column(Integer, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), default=func.now(), server_default=func.now(), nullable=False)
 
-    silo = relationship("Silo", back_populates="operations")
+    silo = relationship("Silo", back_populates="operations", lazy="selectin")
+
+    __table_args__ = (
+        Index("ix_ops_silo_id", silo_id),  # borrado en cascada por silo
+    )
 
 Base.metadata.create_all(engine)
+# create_all no agrega índices a tablas ya existentes
+for index in Operation.__table__.indexes:
+    index.create(engine, checkfirst=True)
+# No heredar conexiones abiertas en los workers (gunicorn --preload hace fork después de importar)
+engine.dispose()
+
+# ---------- Queries ----------
+# lambda_stmt cachea la construcción y compilación del SELECT; solo cambian los parámetros
+LIST_SILOS_STMT = lambda_stmt(
+    lambda: select(Silo.id, Silo.name, Silo.cereal, Silo.balance_kg, Silo.created_at).order_by(Silo.id)
+)
+
+# Kilos con signo: CARGA suma, DESCARGA resta
+SIGNED_AMOUNT = case((Operation.type == "CARGA", Operation.amount), else_=-Operation.amount)
+
+def with_balance_after(page_stmt):
+    """Agrega balance_after (saldo del silo tras cada operación) a una página de operaciones.
+
+    Se calcula hacia atrás desde el saldo actual: balance_kg menos lo movido por las
+    operaciones posteriores del mismo silo. La ventana solo recorre operaciones desde
+    la más vieja de la página, no todo el historial.
+    """
+    page = page_stmt.cte("page")
+    later = (
+        select(
+            Operation.id,
+            (
+                func.sum(SIGNED_AMOUNT).over(partition_by=Operation.silo_id, order_by=Operation.id.desc())
+                - SIGNED_AMOUNT
+            ).label("later_kg"),
+        )
+        .where(Operation.id >= select(func.min(page.c.id)).scalar_subquery())
+        .subquery("later")
+    )
+    return (
+        select(
+            page.c.id, page.c.silo_id, page.c.name, page.c.type, page.c.amount, page.c.created_at,
+            (page.c.balance_kg - later.c.later_kg).label("balance_after"),
+        )
+        .join(later, later.c.id == page.c.id)
+        .order_by(page.c.id.desc())
+    )
+
+def resumen_stmt(limit, before_id=None):
+    stmt = lambda_stmt(
+        lambda: select(
+            Operation.id, Operation.silo_id, Silo.name, Operation.type, Operation.amount, Operation.created_at,
+            Silo.balance_kg,
+        )
+        .join(Silo, Silo.id == Operation.silo_id)
+        .order_by(Operation.id.desc())
+        .limit(limit)
+    )
+    if before_id is not None:
+        # Keyset por id: no depende de que la operación before_id siga existiendo
+        stmt += lambda s: s.where(Operation.id < before_id)
+    stmt += lambda s: with_balance_after(s)
+    return stmt
 
 # ---------- App ----------
-app = Flask(__name__, static_folder="static", template_folder="templates")
+app = Flask(__name__, static_folder="static", static_url_path="/static", template_folder="templates")
 CORS(app)
+# Brotli/gzip para respuestas grandes (listados y /api/resumen); /api/health queda bajo el mínimo
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 512
+Compress(app)
+# /static/* lo sirve WhiteNoise antes de llegar al routing de Flask
+app.wsgi_app = WhiteNoise(app.wsgi_app, root=app.static_folder, prefix="static/")
+
+# Sufijo que Flask-Compress agrega al ETag de la respuesta comprimida ("<hash>:br")
+COMPRESSED_ETAG_SUFFIX = re.compile(r':(?:br|gzip)"')
+
+@app.after_request
+def add_api_etag(response):
+    # Registrado después de Compress, corre antes: ETag sobre el JSON sin comprimir
+    # y 304 si el cliente ya lo tiene. Flask-Compress después le agrega ":br"/":gzip"
+    # pero no evalúa If-None-Match, así que se compara acá sin ese sufijo.
+    if request.method == "GET" and request.path.startswith("/api/") and response.status_code == 200:
+        response.cache_control.no_cache = True
+        response.add_etag()
+        environ = request.environ
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match:
+            environ = {**environ, "HTTP_IF_NONE_MATCH": COMPRESSED_ETAG_SUFFIX.sub('"', if_none_match)}
+        response.make_conditional(environ)
+        if response.status_code == 304 and if_none_match:
+            # El 304 repite el validador que tendría el 200 (con ":br"/":gzip" si era comprimido)
+            etag, _ = response.get_etag()
+            match = re.search(rf'"{re.escape(etag)}(?::(?:br|gzip))?"', if_none_match)
+            if match:
+                response.headers["ETag"] = match.group(0)
+    return response
+
+@app.teardown_appcontext
+def remove_session(exc=None):
+    SessionLocal.remove()
 
 # Timezone for display (Argentina/Córdoba)
-TZ = pytz.timezone("America/Argentina/Cordoba")
+TZ = ZoneInfo("America/Argentina/Cordoba")
+UTC = timezone.utc
+TS_FORMAT = "%Y-%m-%d %H:%M"  # sin segundos
 
-ALLOWED_CEREALES = {"Soja", "Maiz", "Trigo", "Girasol"}
+ALLOWED_CEREALES = frozenset(("Soja", "Maiz", "Trigo", "Girasol"))
+# Normalización case-insensitive: "soja" / "SOJA" -> "Soja"
+CEREALES_BY_KEY = {c.casefold(): c for c in ALLOWED_CEREALES}
 
 def fmt_ts(dt: datetime) -> str:
-    local_dt = dt.astimezone(TZ) if dt.tzinfo else TZ.localize(dt)
-    return local_dt.strftime("%Y-%m-%d %H:%M")  # sin segundos
+    # SQLite (y tablas creadas antes de timezone=True) devuelven naive en UTC
+    return (dt if dt.tzinfo is not None else dt.replace(tzinfo=UTC)).astimezone(TZ).strftime(TS_FORMAT)
+
+def json_response(data, status=200):
+    # orjson serializa bastante más rápido que el json de la stdlib que usa jsonify
+    return app.response_class(orjson.dumps(data, option=orjson.OPT_NAIVE_UTC), status=status, mimetype="application/json")
+
+def parse_body():
+    # Un solo parseo con orjson; cache=False libera el buffer del body enseguida
+    raw = request.get_data(cache=False)
+    if not raw:
+        return {}
+    try:
+        return orjson.loads(raw) or {}
+    except orjson.JSONDecodeError:
+        raise BadRequest("JSON inválido.")
+
+def apply_movement(silo_id, op_type, amount, conditions, values):
+    """Actualiza el saldo y registra la operación en una sola transacción.
+
+    Devuelve (balance_kg, cereal) o None si el UPDATE no aplicó (silo inexistente,
+    stock insuficiente o cereal distinto).
+    """
+    upd = update(Silo).where(Silo.id == silo_id, *conditions).values(**values)
+    if engine.dialect.name == "postgresql":
+        # Un solo round-trip: UPDATE e INSERT encadenados como CTEs
+        upd = upd.returning(Silo.id, Silo.balance_kg, Silo.cereal).cte("upd")
+        ins = insert(Operation).from_select(
+            ["silo_id", "type", "amount"], select(upd.c.id, literal(op_type), literal(amount))
+        ).cte("ins")
+        row = db.execute(select(upd.c.balance_kg, upd.c.cereal).add_cte(ins)).first()
+    else:
+        # SQLite no admite UPDATE dentro de un WITH
+        row = db.execute(
+            upd.returning(Silo.balance_kg, Silo.cereal), execution_options={"synchronize_session": False}
+        ).first()
+        if row is not None:
+            db.execute(insert(Operation).values(silo_id=silo_id, type=op_type, amount=amount))
+    if row is None:
+        db.rollback()
+        return None
+    db.commit()
+    return row
 
 # ---------- API ----------
 @app.get("/api/health")
 def health():
-    return jsonify({"status": "ok"})
+    return json_response({"status": "ok"})
 
 @app.get("/api/silos")
 def list_silos():
-    db = SessionLocal()
-    try:
-        silos = db.query(Silo).order_by(Silo.id).all()
-        data = [
-            {
-                "id": s.id,
-                "name": s.name,
-                "cereal": s.cereal,
-                "balance_kg": s.balance_kg,
-                "created_at": fmt_ts(s.created_at if s.created_at.tzinfo else s.created_at.replace(tzinfo=pytz.utc)),
-            }
-            for s in silos
-        ]
-        return jsonify(data)
-    finally:
-        db.close()
+    # Solo lectura: Core sobre una conexión, sin materializar objetos ORM
+    with engine.connect() as conn:
+        rows = conn.execute(LIST_SILOS_STMT).all()
+    data = [
+        {
+            "id": silo_id,
+            "name": name,
+            "cereal": cereal,
+            "balance_kg": balance_kg,
+            "created_at": fmt_ts(created_at),
+        }
+        for silo_id, name, cereal, balance_kg, created_at in rows
+    ]
+    return json_response(data)
 
 @app.post("/api/silos")
 def create_silo():
-    db = SessionLocal()
-    body = request.get_json(force=True) or {}
+    body = parse_body()
     name = (body.get("name") or "").strip()
     if not name:
-        return jsonify({"error": "El nombre es obligatorio."}), 400
+        return json_response({"error": "El nombre es obligatorio."}, 400)
     try:
         s = Silo(name=name, cereal=None, balance_kg=0)
         db.add(s)
         db.commit()
-        return jsonify({"message": f"Silo '{name}' creado correctamente.", "id": s.id}), 201
+        return json_response({"message": f"Silo '{name}' creado correctamente.", "id": s.id}, 201)
     except IntegrityError:
         db.rollback()
-        return jsonify({"error": "Ya existe un silo con ese nombre."}), 409
-    finally:
-        db.close()
+        return json_response({"error": "Ya existe un silo con ese nombre."}, 409)
 
 @app.patch("/api/silos/<int:silo_id>")
 def rename_silo(silo_id):
-    db = SessionLocal()
-    body = request.get_json(force=True) or {}
+    body = parse_body()
     new_name = (body.get("name") or "").strip()
     if not new_name:
-        db.close()
-        return jsonify({"error": "El nuevo nombre es obligatorio."}), 400
+        return json_response({"error": "El nuevo nombre es obligatorio."}, 400)
+    s = db.get(Silo, silo_id)
+    if not s:
+        return json_response({"error": "Silo no encontrado."}, 404)
     try:
-        s = db.query(Silo).get(silo_id)
-        if not s:
-            db.close()
-            return jsonify({"error": "Silo no encontrado."}), 404
         s.name = new_name
         db.commit()
-        return jsonify({"message": "Nombre actualizado."})
+        return json_response({"message": "Nombre actualizado."})
     except IntegrityError:
         db.rollback()
-        return jsonify({"error": "Ya existe un silo con ese nombre."}), 409
-    finally:
-        db.close()
+        return json_response({"error": "Ya existe un silo con ese nombre."}, 409)
 
 @app.delete("/api/silos/<int:silo_id>")
 def delete_silo(silo_id):
-    db = SessionLocal()
-    try:
-        s = db.query(Silo).get(silo_id)
-        if not s:
-            return jsonify({"error": "Silo no encontrado."}), 404
-        db.delete(s)
-        db.commit()
-        return jsonify({"message": "Silo eliminado."})
-    finally:
-        db.close()
+    s = db.get(Silo, silo_id)
+    if not s:
+        return json_response({"error": "Silo no encontrado."}, 404)
+    db.delete(s)
+    db.commit()
+    return json_response({"message": "Silo eliminado."})
 
 @app.post("/api/silos/<int:silo_id>/cargar")
 def cargar(silo_id):
-    db = SessionLocal()
-    body = request.get_json(force=True) or {}
+    body = parse_body()
     amount = int(body.get("amount") or 0)
     cereal = body.get("cereal")
+    if isinstance(cereal, str):
+        cereal = CEREALES_BY_KEY.get(cereal.strip().casefold(), cereal)
     if amount <= 0:
-        db.close()
-        return jsonify({"error": "La cantidad debe ser mayor a 0."}), 400
-    try:
-        s = db.query(Silo).get(silo_id)
+        return json_response({"error": "La cantidad debe ser mayor a 0."}, 400)
+    # UPDATE condicional atómico: evita que dos cargas simultáneas pisen el saldo
+    conditions = []
+    values = {"balance_kg": Silo.balance_kg + amount}
+    if cereal in ALLOWED_CEREALES:
+        # Si el silo no tiene cereal se setea; si ya tiene, debe ser el mismo
+        conditions.append(or_(Silo.cereal.is_(None), Silo.cereal == cereal))
+        values["cereal"] = func.coalesce(Silo.cereal, cereal)
+    else:
+        conditions.append(Silo.cereal == cereal if cereal else Silo.cereal.isnot(None))
+    row = apply_movement(silo_id, "CARGA", amount, conditions, values)
+    if row is None:
+        # Solo en el camino de error: averiguar por qué no se actualizó
+        s = db.get(Silo, silo_id)
         if not s:
-            return jsonify({"error": "Silo no encontrado."}), 404
-        # Si el silo está vacío y no tiene cereal, hay que setearlo
-        if s.balance_kg == 0 and (s.cereal is None):
-            if not cereal or cereal not in ALLOWED_CEREALES:
-                return jsonify({"error": "Debe seleccionar el cereal (Soja, Maiz, Trigo, Girasol)."}), 400
-            s.cereal = cereal
-        # Si ya tiene cereal, no permitir cambiar
-        if s.cereal and cereal and cereal != s.cereal:
-            return jsonify({"error": f"El silo ya almacena {s.cereal}. No puede cambiarse."}), 400
-        s.balance_kg += amount
-        op = Operation(silo_id=s.id, type="CARGA", amount=amount)
-        db.add(op)
-        db.commit()
-        return jsonify({"message": "Carga registrada.", "balance_kg": s.balance_kg, "cereal": s.cereal})
-    finally:
-        db.close()
+            return json_response({"error": "Silo no encontrado."}, 404)
+        if s.cereal is None:
+            return json_response({"error": "Debe seleccionar el cereal (Soja, Maiz, Trigo, Girasol)."}, 400)
+        return json_response({"error": f"El silo ya almacena {s.cereal}. No puede cambiarse."}, 400)
+    return json_response({"message": "Carga registrada.", "balance_kg": row.balance_kg, "cereal": row.cereal})
 
 @app.post("/api/silos/<int:silo_id>/descargar")
 def descargar(silo_id):
-    db = SessionLocal()
-    body = request.get_json(force=True) or {}
+    body = parse_body()
     amount = int(body.get("amount") or 0)
     if amount <= 0:
-        db.close()
-        return jsonify({"error": "La cantidad debe ser mayor a 0."}), 400
-    try:
-        s = db.query(Silo).get(silo_id)
-        if not s:
-            return jsonify({"error": "Silo no encontrado."}), 404
-        if s.balance_kg - amount < 0:
-            return jsonify({"error": "No hay suficiente stock en el silo."}), 400
-        s.balance_kg -= amount
-        op = Operation(silo_id=s.id, type="DESCARGA", amount=amount)
-        db.add(op)
-        db.commit()
-        return jsonify({"message": "Descarga registrada.", "balance_kg": s.balance_kg})
-    finally:
-        db.close()
+        return json_response({"error": "La cantidad debe ser mayor a 0."}, 400)
+    row = apply_movement(
+        silo_id, "DESCARGA", amount, [Silo.balance_kg >= amount], {"balance_kg": Silo.balance_kg - amount}
+    )
+    if row is None:
+        if not db.get(Silo, silo_id):
+            return json_response({"error": "Silo no encontrado."}, 404)
+        return json_response({"error": "No hay suficiente stock en el silo."}, 400)
+    return json_response({"message": "Descarga registrada.", "balance_kg": row.balance_kg})
 
 @app.get("/api/resumen")
 def resumen():
-    db = SessionLocal()
-    try:
-        ops = db.query(Operation).order_by(Operation.created_at.desc(), Operation.id.desc()).all()
-        data = []
-        for o in ops:
-            data.append({
-                "id": o.id,
-                "silo_id": o.silo_id,
-                "silo_name": o.silo.name if o.silo else None,
-                "type": o.type,
-                "amount": o.amount,
-                "timestamp": fmt_ts(o.created_at if o.created_at.tzinfo else o.created_at.replace(tzinfo=pytz.utc)),
-                "balance_kg_post": db.query(Silo).get(o.silo_id).balance_kg if o.silo_id else None,
-            })
-        return jsonify(data)
-    finally:
-        db.close()
+    # Paginado por keyset: ?limit=50&before_id=<id de la última operación recibida>
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    before_id = request.args.get("before_id", type=int)
+    with engine.connect() as conn:
+        rows = conn.execute(resumen_stmt(limit, before_id)).all()
+    data = [
+        {
+            "id": op_id,
+            "silo_id": silo_id,
+            "silo_name": silo_name,
+            "type": op_type,
+            "amount": amount,
+            "timestamp": fmt_ts(created_at),
+            "balance_after": balance_after,
+        }
+        for op_id, silo_id, silo_name, op_type, amount, created_at, balance_after in rows
+    ]
+    next_before_id = data[-1]["id"] if len(data) == limit else None
+    return json_response({"items": data, "next_before_id": next_before_id})
 
 # ---------- Frontend routes (serve React app) ----------
+# manifest y service worker tienen que estar en la raíz (scope del SW)
+@app.get("/manifest.json")
+def manifest():
+    return send_from_directory(app.static_folder, "manifest.json", conditional=True)
+
+@app.get("/service-worker.js")
+def service_worker():
+    return send_from_directory(app.static_folder, "service-worker.js", conditional=True)
+
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>")
 def serve_frontend(path):
-    # Serve PWA static assets directly
-    if path.startswith("icons/"):
-        return send_from_directory("static", path)
-    if path in ("manifest.json", "service-worker.js"):
-        return send_from_directory("static", path)
     # Fallback to index.html (React SPA)
     return render_template("index.html")
 
@@ -1,4 +1,4 @@
-const CACHE = "silos-pwa-v1";
+const CACHE = "silos-pwa-v2";
 
 self.addEventListener("install", (e) => {
   e.waitUntil(caches.open(CACHE).then(cache => cache.addAll([